@@ -111,12 +111,14 @@ class ArrowConsumer():
     n_bytes=2,
     seqlen="auto",
     class_to_id = None,
+    pin_memory = True,
   ):
     """Read `Consumer <gperc.data.html>`_ for documentation. This class uses PyArrow as underlying table
     however tokenisation etc. still has to be done for each sample when using ``__getitem__``. This method
     exclusively works for classification problems (``style=='diff'``)."""
     self.fps, self._mode = convert_to_gperc_consumer_ir(fps)
     self.class_to_id = class_to_id
+    self.pin_memory = pin_memory and torch.cuda.is_available() # page-locked only makes sense with a GPU
     self.id_to_class = None
 
     if class_to_id != None:
@@ -296,7 +298,8 @@ class ArrowConsumer():
     return {
       "input_array": input_array,
       "attention_mask": attention_mask,
-      "class": labels
+      "class": labels,
+      "n_tokens": attention_mask.sum(-1), # on host so trainer does not have to sum the mask on device
     }
 
   def create_batches(self, batch_size, drop_last=False, seed=4):
@@ -338,4 +341,7 @@ class ArrowConsumer():
       x = next(self._iter_batches)
 
     data = self[x]
+    if self.pin_memory:
+      # page-locked tensors can be copied to the GPU with ``non_blocking = True``
+      data = {k: v.pin_memory() for k, v in data.items()}
     return data
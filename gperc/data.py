@@ -298,6 +298,7 @@ class Consumer:
         seqlen="auto",
         verbose=False,
         class_to_id=None,
+        pin_memory=True,
         _unittesting=False
     ):
         r"""Consumer takes in list of files along with it's meta data and becomes a callable generator.
@@ -363,6 +364,8 @@ class Consumer:
           seqlen (list, optional): the total number of tokens for each sample
           verbose (bool, optional): if True, prints out the progress of the data
           class_to_id (dict, optional): if not None, this is a dictionary that maps the class names to the integer ids.
+          pin_memory (bool, optional): if True and a GPU is available, batches from ``get_next_batch`` are returned in
+              page-locked memory so they can be copied asynchronously to the device.
           _unittesting (bool): This is a private variable that is used to test the data reader. Keep at False
         """
         # parse the fps and covert to fixed internal reprensentaion -> {"meta": ["file1.txt", "file2.txt", ...]}
@@ -383,6 +386,7 @@ class Consumer:
         self.n_bytes = n_bytes
         self.seqlen = seqlen
         self.class_to_id = class_to_id
+        self.pin_memory = pin_memory and torch.cuda.is_available()
 
         # vocabulary building process special tokens
         vocab_size = int(2 ** (8 * n_bytes))
@@ -766,7 +770,11 @@ class Consumer:
         attention_mask = torch.tensor(attention_mask, dtype=torch.long)
 
         # now we take the data structure it according to the user's request
-        _dc = {"input_array": out, "attention_mask": attention_mask}
+        _dc = {
+            "input_array": out,
+            "attention_mask": attention_mask,
+            "n_tokens": attention_mask.sum(-1),  # on host so trainer does not have to sum the mask on device
+        }
         if query == "supervised":
             if isinstance(self.class_to_id, dict):
                 class_tensor = torch.tensor([self.class_to_id[x] for x in classes]).long()
@@ -808,5 +816,9 @@ class Consumer:
             self.create_batches(self.batch_size, self.drop_last, self.seed + 1)
             x = next(self._iter_batches)
 
-        return self[x, query]
+        data = self[x, query]
+        if self.pin_memory:
+            # page-locked tensors can be copied to the GPU with ``non_blocking = True``
+            data = {k: v.pin_memory() for k, v in data.items()}
+        return data
 
@@ -24,6 +24,7 @@ import math
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 VALID_REDUCTIONS = ["mean", "max", "sum", "last", "first", "eot", None]
 
@@ -383,6 +384,9 @@ class Perceiver(nn.Module):
         self.processors = nn.ModuleList([ProcessorBlock(config) for _ in range(config.num_layers)])
         self.decoder_block = DecoderBlock(config)
 
+        # when True the processor activations are recomputed in backward pass, see ``enable_gradient_checkpointing``
+        self.gradient_checkpointing = False
+
     def num_parameters(self, include_non_trainable: bool = True):
         r"""function that returns the number of parameters in the modle
 
@@ -432,7 +436,12 @@ class Perceiver(nn.Module):
 
         # step 3: pass through the processor blocks
         for i, p_block in enumerate(self.processors):
-            latents, _, attentions = p_block(latents, None, attentions)
+            if self.gradient_checkpointing and self.training:
+                # call the block directly since the attentions list cannot be replayed during recompute
+                latents, A = checkpoint(p_block.b, latents, latents, use_reentrant=False)
+                attentions.append(A)
+            else:
+                latents, _, attentions = p_block(latents, None, attentions)
 
         # step 4: pass through the decoder block
         logits, attentions = self.decoder_block(input_array, latents, output_array, attentions)
@@ -443,6 +452,26 @@ class Perceiver(nn.Module):
         return logits
 
 
+def enable_gradient_checkpointing(model, enable: bool = True):
+    r"""Turn on activation checkpointing for the processor blocks of every ``Perceiver`` in ``model``. During
+    training the activations of each ``ProcessorBlock`` are not stored but recomputed in the backward pass, this
+    trades some compute for a large reduction in memory and thus allows for larger batches. This uses
+    ``torch.utils.checkpoint`` with ``use_reentrant=False`` so it needs ``torch>=1.11``.
+
+    Args:
+        model (torch.nn.Module): ``Perceiver`` or any model that contains one, eg. ``PerceiverImage``
+        enable (bool, optional): If false turns off checkpointing
+
+    Returns:
+        torch.nn.Module: the same ``model``
+    """
+    perceivers = [m for m in model.modules() if isinstance(m, Perceiver)]
+    assert len(perceivers), f"No Perceiver found in {type(model).__name__}"
+    for m in perceivers:
+        m.gradient_checkpointing = enable
+    return model
+
+
 def get_distributed_model(config):
     r"""This function returns the model that is used for distributed training. This is **not** a wrapper
     around ``Perceiver`` but instead returns a ``Pipe`` object.
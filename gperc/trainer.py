@@ -8,32 +8,278 @@ This is a generic trainer built for the gperc project. More documentation will b
 import os
 import torch
 from tqdm.auto import trange
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from .utils import timeit
+from .data import Consumer
+from .models import enable_gradient_checkpointing
+
+
+_LOG_KEYS = [
+  "step", "forward_pass_time", "backward_pass_time", "total_time", "bytes_processed", "bytes_processed_per_second",
+  "loss_avg", "acc_avg", "class_wise_bytes_processed", "loss_class", "acc_class",
+]
+
+
+def _load(fp, weights_only = False):
+  """``torch.load`` the file to CPU, the tensors are memory mapped from disk instead of being read into
+  memory first. Falls back to a regular load on versions of torch without ``mmap``."""
+  try:
+    return torch.load(fp, map_location = "cpu", mmap = True, weights_only = weights_only)
+  except TypeError:
+    return torch.load(fp, map_location = "cpu")
+
+
+# keys in the batch that are meant to stay on host
+_HOST_KEYS = ["n_tokens"]
+
+
+def _to_cpu(state):
+  """Recursively copies all the tensors in a (nested) ``state_dict`` to CPU, the copy means that the
+  result is not changed when training continues. The copy is blocking on purpose, ``non_blocking`` would
+  allocate pinned host memory for the full state that the caching host allocator keeps around."""
+  if isinstance(state, torch.Tensor):
+    return state.detach().to("cpu", copy = True)
+  if isinstance(state, dict):
+    return {k: _to_cpu(v) for k, v in state.items()}
+  if isinstance(state, (list, tuple)):
+    return type(state)(_to_cpu(v) for v in state)
+  return state
+
+
+class _BatchSampler():
+  def __init__(self, data, query = None):
+    """Yields the batches of indices made by ``data.create_batches``, at the end of each epoch the batches
+    are shuffled with a new seed same as ``get_next_batch``. If ``query`` is given each batch is yielded
+    as ``(indices, query)``, see ``gperc.Consumer.__getitem__``."""
+    self.data = data
+    self.query = query
+
+  def __len__(self):
+    return len(self.data._batches)
+
+  def __iter__(self):
+    for x in self.data._batches:
+      yield x if self.query == None else (x, self.query)
+    self.data.create_batches(self.data.batch_size, self.data.drop_last, self.data.seed + 1)
+
+
+class _LoaderConsumer():
+  def __init__(self, data, loader):
+    """Exposes a ``torch.utils.data.DataLoader`` over a ``gperc.Consumer/ArrowConsumer`` with the same
+    ``get_next_batch`` API so it can be passed to ``Trainer.train``, see ``Trainer.wrap_dataloader``"""
+    self.data = data
+    self.loader = loader
+    self.n_bytes = data.n_bytes
+    self.n_classes = data.get_dict()["n_classes"] # ``gperc.Consumer`` does not have a public n_classes
+    self._iter = iter(loader)
+
+  @property
+  def _batches(self):
+    return self.data._batches
+
+  def get_next_batch(self):
+    try:
+      return next(self._iter)
+    except StopIteration:
+      # with persistent workers this does not respawn the processes
+      self._iter = iter(self.loader)
+      return next(self._iter)
+
+
+class _PrefetchLoader():
+  def __init__(self, data, device, stream = None):
+    """
+    Wraps a ``gperc.Consumer`` or ``gperc.ArrowConsumer`` and copies the next batch to ``device`` on
+    a side CUDA ``stream`` while the current batch is being processed. When ``stream`` is None this
+    simply returns the batches from ``data``.
+
+    Args:
+      data (``gperc.Consumer/ArrowConsumer``): The data to read from, batches must be created
+      device (torch.device): The device to copy the batches to
+      stream (torch.cuda.Stream): The stream to perform the copies on
+    """
+    self.data = data
+    self.device = device
+    self.stream = stream
+    self._next_batch = None
+
+  def _preload(self):
+    batch = self.data.get_next_batch()
+    with torch.cuda.stream(self.stream):
+      batch = {
+        k: v.to(self.device, non_blocking = True) if isinstance(v, torch.Tensor) and k not in _HOST_KEYS else v
+        for k, v in batch.items()
+      }
+    return batch
+
+  def get_next_batch(self):
+    if self.stream == None:
+      return self.data.get_next_batch()
+
+    if self._next_batch == None:
+      self._next_batch = self._preload()
+
+    # wait for the copy to complete and tell the allocator that these are now used on the main stream
+    main_stream = torch.cuda.current_stream(self.device)
+    main_stream.wait_stream(self.stream)
+    batch = self._next_batch
+    for v in batch.values():
+      if isinstance(v, torch.Tensor) and v.is_cuda:
+        v.record_stream(main_stream)
+
+    # start copying the next batch while this one is processed
+    self._next_batch = self._preload()
+    return batch
+
+
+class _StepGraph():
+  def __init__(self, step_fn, optim, n_warmup = 3):
+    """
+    Captures one full training step ``step_fn`` (forward, backward and ``optim.step()``) in a
+    ``torch.cuda.CUDAGraph`` and replays it for the following batches instead of launching each kernel
+    again. The batch is copied into static buffers each step since the graph always reads from the same
+    memory, so this only works when every batch has the same keys and shapes, for any other batch
+    ``__call__`` returns None and the caller should run the step eagerly.
+
+    .. note::
+
+        ``step_fn`` must not sync with the host and ``optim`` must be graph safe, eg. create
+        ``torch.optim.Adam(..., capturable = True)``.
+
+    Args:
+      step_fn (function): Takes the batch dict and returns a tuple of tensors
+      optim (torch.optim.Optimizer): The optimizer that ``step_fn`` steps
+      n_warmup (int): The number of steps to run eagerly on a side stream before capturing
+    """
+    self.step_fn = step_fn
+    self.optim = optim
+    self.n_warmup = n_warmup
+    self.graph = None
+    self.static_batch = None
+    self.static_out = None
+    self._n_steps = 0
+
+  def __call__(self, batch):
+    if self.static_batch == None:
+      self.static_batch = {k: v.clone() for k, v in batch.items()}
+    elif batch.keys() != self.static_batch.keys() or any(v.shape != self.static_batch[k].shape for k, v in batch.items()):
+      return None
+    else:
+      for k, v in batch.items():
+        self.static_batch[k].copy_(v, non_blocking = True)
+
+    if self._n_steps < self.n_warmup:
+      # warmup on a side stream so that lazy state like optimizer buffers are created before capture
+      side_stream = torch.cuda.Stream()
+      side_stream.wait_stream(torch.cuda.current_stream())
+      with torch.cuda.stream(side_stream):
+        out = self.step_fn(self.static_batch)
+      torch.cuda.current_stream().wait_stream(side_stream)
+      self._n_steps += 1
+      return out
+
+    if self.graph == None:
+      # gradients are set to None so that the backward in the graph assigns them instead of accumulating
+      self.optim.zero_grad(set_to_none = True)
+      self.graph = torch.cuda.CUDAGraph()
+      with torch.cuda.graph(self.graph):
+        self.static_out = self.step_fn(self.static_batch)
+
+    # capture does not run the kernels, so replay for the batch used during capture as well
+    self.graph.replay()
+    self._n_steps += 1
+    return self.static_out
+
 
 class Trainer():
-  def __init__(self, model, save_folder = None, save_every = 1000, client = None):
+  def __init__(
+    self,
+    model,
+    save_folder = None,
+    save_every = 1000,
+    client = None,
+    gradient_checkpointing = False,
+    precision = "fp32",
+    compile = False,
+    cuda_graph = False,
+    per_class_logging = False,
+  ):
     """
     Generic trainer for the ``gperc`` project.
 
     Args:
       model (torch.nn.Module): The model to train.
       client (function): A function that takes a dict as input and logs it to a remote server.
+      gradient_checkpointing (bool): Recompute processor activations in the backward pass to save memory,
+        see ``gperc.models.enable_gradient_checkpointing``, needs ``torch>=1.11``
+      precision (str): One of ``"fp32"``, ``"bf16"`` or ``"fp16"``, the forward pass is run under ``torch.autocast``
+        for the half precisions (needs ``torch>=1.10``) and ``"fp16"`` also scales the loss with
+        ``torch.amp.GradScaler``
+      compile (bool): Compile the model once with ``torch.compile(mode = "reduce-overhead")``, needs ``torch>=2.0``
+      cuda_graph (bool): Capture the training step in a ``torch.cuda.CUDAGraph`` and replay it, only for fixed
+        shape batches and ``accum_steps == 1``, the optimizer must be created with ``capturable = True``
+      per_class_logging (bool): Also log the bytes processed, loss and accuracy for each class, this needs
+        the per sample loss so is off by default
     """
+    assert precision in ["fp32", "bf16", "fp16"], f"precision should be one of 'fp32', 'bf16' or 'fp16' got: {precision}"
+    assert not (cuda_graph and precision == "fp16"), "cuda_graph cannot be used with fp16 since GradScaler syncs with host"
+    assert not (cuda_graph and compile), "cuda_graph cannot be used with compile, 'reduce-overhead' already uses CUDA graphs"
     self.model = model
     self.save_folder = save_folder
     self.save_every = save_every
     self.client = client
     self.model_config = model.config
-    self.device = next(self.model.parameters()).device
+    self._n_classes = self.model_config["n_classes"]
+
+    # keys for the logging dict are built once instead of formatting every step
+    self._prefix = {True: "train", False: "val"}
+    self._keys = {train: {k: f"{prefix}/{k}" for k in _LOG_KEYS} for train, prefix in self._prefix.items()}
+
+    if gradient_checkpointing:
+      enable_gradient_checkpointing(self.model)
+    if compile:
+      # compiled module wraps the original as ``_orig_mod``, that is what gets saved and loaded
+      self.model = torch.compile(self.model, mode = "reduce-overhead", fullgraph = False)
+    self._device_param = next(self.model.parameters()) # ``device`` follows this if the model is moved later
+    self._copy_stream = None # created in ``train`` for the current device
+
+    # mixed precision, with ``enabled = False`` the scaler simply passes through to the optimizer
+    self.precision = precision
+    self._autocast_dtype = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+      self.scaler = torch.amp.GradScaler("cuda", enabled = precision == "fp16")
+    else:
+      # ``torch.amp.GradScaler`` needs ``torch>=2.3``, the older one is deprecated after that
+      self.scaler = torch.cuda.amp.GradScaler(enabled = precision == "fp16")
+
+    # the step graph is created on the first training batch, and again when any of the arguments it
+    # captured changes, see ``__call__``
+    self.cuda_graph = cuda_graph
+    self._step_graph = None
+    self._step_graph_key = None
+    self.per_class_logging = per_class_logging
+    self._class_buffers = {} # see ``_get_class_buffers``
+
+    # checkpoints are written on a background thread, see ``save``
+    self._save_executor = ThreadPoolExecutor(max_workers = 1)
+    self._save_futures = []
 
     if save_folder != None:
       os.makedirs(self.save_folder, exist_ok = True) # create this just in case
       with open(os.path.join(self.save_folder, "config.json"), "w") as f:
         f.write(self.model_config.to_json())
 
+  @property
+  def device(self):
+    """The device the model currently is on"""
+    return self._device_param.device
+
   def save(self, name, optim = None, lr_scheduler = None):
-    """save the items to ``self.save_folder/name/`` folder
+    """save the items to ``self.save_folder/name/`` folder. The states are copied to CPU and then written
+    to disk on a background thread so training is not blocked, call ``wait_for_saves`` to make sure
+    that the files are written.
 
     Args:
         name (str): The name of the save folder
@@ -48,11 +294,27 @@ class Trainer():
     step_folder = os.path.join(self.save_folder, name)
     print(f"Saving in folder: {step_folder}")
     os.makedirs(step_folder, exist_ok = True)
-    torch.save(self.model.state_dict(), os.path.join(step_folder, "model.pt"))
+    model = getattr(self.model, "_orig_mod", self.model)
+    states = [(model.state_dict(), "model.pt")]
     if optim != None:
-      torch.save(optim.state_dict(), os.path.join(step_folder, "optim.pt"))
+      states.append((optim.state_dict(), "optim.pt"))
     if lr_scheduler != None:
-      torch.save(lr_scheduler.state_dict(), os.path.join(step_folder, "lr_scheduler.pt"))
+      states.append((lr_scheduler.state_dict(), "lr_scheduler.pt"))
+
+    states = [(_to_cpu(state), os.path.join(step_folder, fname)) for state, fname in states]
+    for state, fp in states:
+      self._save_futures.append(self._save_executor.submit(torch.save, state, fp))
+
+  def wait_for_saves(self):
+    """Block till all the checkpoints from ``save`` are written, raises any error from the writer"""
+    futures, self._save_futures = self._save_futures, []
+    for f in futures:
+      f.result()
+
+  def close(self):
+    """Wait for pending checkpoints and shutdown the background writer, ``save`` cannot be used after this"""
+    self.wait_for_saves()
+    self._save_executor.shutdown(wait = True)
  
   def load(self, save_folder, optim = None, lr_scheduler = None):
     """
@@ -63,13 +325,147 @@ class Trainer():
       optim (torch.optim.Optimizer): The optimizer to load
       lr_scheduler (torch.optim.lr_scheduler): The lr scheduler to load
     """
-    self.model.load_state_dict(torch.load(os.path.join(save_folder, "model.pt")))
+    self.wait_for_saves() # in case this folder is still being written
+    model = getattr(self.model, "_orig_mod", self.model)
+    model.load_state_dict(_load(os.path.join(save_folder, "model.pt"), weights_only = True))
     if optim != None and os.path.exists(os.path.join(save_folder, "optim.pt")):
-      self.optim.load_state_dict(torch.load(os.path.join(save_folder, "optim.pt")))
+      optim.load_state_dict(_load(os.path.join(save_folder, "optim.pt")))
     if lr_scheduler != None and os.path.exists(os.path.join(save_folder, "lr_scheduler.pt")):
-      self.lr_scheduler.load_state_dict(torch.load(os.path.join(save_folder, "lr_scheduler.pt")))
+      lr_scheduler.load_state_dict(_load(os.path.join(save_folder, "lr_scheduler.pt")))
+
+  def _forward(self, batch, n_bytes, n_classes, count_bytes = True):
+    """Forward pass and loss for the ``batch``, returns a tuple with ``(forward_pass_time, mean_loss,
+    log_tensor, log_vecs)`` where the last two hold the stacked values that are logged, ``log_vecs`` is None
+    when ``per_class_logging`` is off. If ``count_bytes`` is False the total bytes are not added to
+    ``log_tensor`` since the caller already has the token counts."""
+    device = self.device
+    if self.precision == "fp32":
+      forward_pass_time, out = timeit(self.model)(batch["input_array"])
+    else:
+      # ``torch.autocast`` needs ``torch>=1.10`` so it is only used for the half precisions
+      with torch.autocast(
+        device.type,
+        dtype = self._autocast_dtype,
+        cache_enabled = not self.cuda_graph, # autocast cache is not safe in graph capture
+      ):
+        forward_pass_time, out = timeit(self.model)(batch["input_array"])
+
+    # make is so that any task can be run with this, loss is always calculated in fp32. ``reshape`` is a view
+    # when ``out.is_contiguous()`` and only copies the logits when it is not
+    out = out.float().reshape(-1, self._n_classes)
+    target = batch["class"].reshape(-1)
+    if self.per_class_logging:
+      loss = torch.nn.functional.cross_entropy(out, target, reduction = "none")
+      _mean_loss = loss.mean()
+    else:
+      # no per sample loss is needed, so let the kernel do the reduction
+      _mean_loss = torch.nn.functional.cross_entropy(out, target)
+    with torch.no_grad():
+      preds = out.argmax(-1)
+      correct_f = preds.eq(target).float()
+      acc = correct_f.mean()
+
+    # capture the meta for the processed batch, everything that is logged goes to host in a single transfer
+    # at the end of the step, in double so the byte counts stay exact
+    am = batch["attention_mask"]
+    with torch.no_grad():
+      scalars = [_mean_loss.detach(), acc]
+      if count_bytes:
+        scalars.append(am.sum() * n_bytes)
+      log_tensor = torch.stack([x.double() for x in scalars])
+      log_vecs = None
+
+      if self.per_class_logging:
+        # sum the per sample values into their classes on device, this avoids syncing for each sample
+        classes = batch["class"]
+        B = classes.shape[0]
+        per_sample_loss = loss.view(B, -1).mean(-1)
+        per_sample_acc = correct_f.view(B, -1).mean(-1)
+        per_sample_bytes = (batch["n_tokens"] if "n_tokens" in batch else am.sum(-1)) * n_bytes
+        bytes_by_class, loss_by_class, acc_by_class = self._get_class_buffers(n_classes, device)
+        bytes_by_class.zero_().scatter_add_(0, classes, per_sample_bytes.to(bytes_by_class.dtype))
+        loss_by_class.zero_().scatter_add_(0, classes, per_sample_loss)
+        acc_by_class.zero_().scatter_add_(0, classes, per_sample_acc)
+        log_vecs = torch.stack([bytes_by_class.double(), loss_by_class.double(), acc_by_class.double()])
+
+    return forward_pass_time, _mean_loss, log_tensor, log_vecs
+
+  def _backward(self, _mean_loss, optim, grad_clip, step, accum_steps):
+    """Backward pass and optimizer step, gradients are accumulated over ``accum_steps`` batches. Returns
+    the time taken by ``optim.step()``"""
+    if step % accum_steps == 0:
+      optim.zero_grad(set_to_none = True)
+    self.scaler.scale(_mean_loss / accum_steps).backward()
+
+    backward_pass_time = 0.
+    if (step + 1) % accum_steps == 0:
+      self.scaler.unscale_(optim) # so that clipping is applied on the true gradients
+      torch.nn.utils.clip_grad_value_(self.model.parameters(), grad_clip) # clip gradient values, skips ``p.grad == None``
 
-  def __call__(self, batch, step, n_bytes, n_classes, pbar, train = True, grad_clip = 1.0, optim = None):
+      backward_pass_time, _ = timeit(self.scaler.step)(optim)
+      self.scaler.update()
+    return backward_pass_time
+
+  def _graph_step(self, batch, n_bytes, n_classes, optim, grad_clip, count_bytes):
+    """The full training step that is captured by ``_StepGraph``, returns ``(log_tensor, log_vecs)``"""
+    _, _mean_loss, log_tensor, log_vecs = self._forward(batch, n_bytes, n_classes, count_bytes)
+    self._backward(_mean_loss, optim, grad_clip, step = 0, accum_steps = 1)
+    return log_tensor, log_vecs
+
+  def _get_class_buffers(self, n_classes, device):
+    """Returns the ``(bytes, loss, acc)`` per class accumulators, these are allocated once and reused every
+    step. They are never freed since a captured ``_StepGraph`` keeps writing to the same memory."""
+    key = (n_classes, device)
+    if key not in self._class_buffers:
+      self._class_buffers[key] = (
+        torch.zeros(n_classes, dtype = torch.long, device = device),
+        torch.zeros(n_classes, device = device),
+        torch.zeros(n_classes, device = device),
+      )
+    return self._class_buffers[key]
+
+  @staticmethod
+  def wrap_dataloader(data, num_workers = 4, prefetch_factor = 4, pin_memory = None):
+    """Wrap the consumer in a ``torch.utils.data.DataLoader`` so that reading and tokenising the next
+    batches happens in background workers while the model is training. The workers are persistent so
+    they are not created again each epoch.
+
+    .. code-block:: python
+
+        data = ArrowConsumer(fps, n_bytes = 1, class_to_id = class_to_id)
+        data.create_batches(32)
+        trainer.train(optim, Trainer.wrap_dataloader(data), n_steps = 1000)
+
+    Args:
+      data (``gperc.Consumer/ArrowConsumer``): The data to wrap, batches must be created. A ``gperc.Consumer``
+        must be in supervised mode, see ``Consumer.set_supervised_mode``
+      num_workers (int): The number of worker processes
+      prefetch_factor (int): The number of batches each worker loads in advance
+      pin_memory (bool): Return batches in page-locked memory, defaults to ``torch.cuda.is_available()``
+
+    Returns:
+      An object with ``get_next_batch`` that can be used as ``train_data`` or ``test_data``, the
+      ``DataLoader`` is available as ``.loader``
+    """
+    assert hasattr(data, "_batches"), "You must create batches first data.create_batches()"
+    if pin_memory == None:
+      pin_memory = torch.cuda.is_available()
+    kwargs = {}
+    if num_workers > 0:
+      kwargs.update({"persistent_workers": True, "prefetch_factor": prefetch_factor})
+    # ``gperc.Consumer`` only returns the classes for the supervised query
+    query = "supervised" if isinstance(data, Consumer) else None
+    loader = torch.utils.data.DataLoader(
+      data,
+      sampler = _BatchSampler(data, query),
+      batch_size = None, # each item from the sampler already is a batch
+      num_workers = num_workers,
+      pin_memory = pin_memory,
+      **kwargs
+    )
+    return _LoaderConsumer(data, loader)
+
+  def __call__(self, batch, step, n_bytes, n_classes, pbar, train = True, grad_clip = 1.0, optim = None, accum_steps = 1):
     """
     Train or test a batch, returns the current batch meta.
 
@@ -82,78 +478,100 @@ class Trainer():
       train (bool): Whether to train or test
       grad_clip (float): The gradient clipping value, defaults to 1.0
       optim (torch.optim.Optimizer): The optimizer to use, must be defined if ``train == True``
+      accum_steps (int): The number of batches to accumulate gradients over before ``optim.step()``, defaults to 1
     """
     # initial setup
     self.model.train() if train else self.model.eval()
-    prefix = "train" if train else "val"
+    keys = self._keys[train]
     batch_meta = batch.pop("meta", {}) # create meta dict
-    batch_meta[f"{prefix}/step"] = step
+    batch_meta[keys["step"]] = step
 
-    # forward pass
-    batch = {k:v.to(self.device) for k,v in batch.items()}
-    forward_pass_time, out = timeit(self.model)(batch["input_array"])
-    batch_meta[f"{prefix}/forward_pass_time"] = forward_pass_time
+    # token counts from the consumers stay on host so the bytes processed are known without a sync
+    n_tokens = batch.pop("n_tokens", None)
+    count_bytes = n_tokens == None
 
-    # make is so that any task can be run with this
-    out = out.contiguous().view(-1, self.model_config["n_classes"])
-    target = batch["class"].contiguous().view(-1)
-    loss = torch.nn.functional.cross_entropy(out, target, reduction = "none")
-    acc = out.argmax(-1).eq(target).float().mean()
-    _mean_loss = loss.mean()
+    # batches from the consumers are pinned so the copy to GPU need not block
+    device = self.device
+    non_blocking = device.type == "cuda"
+    batch = {k:v.to(device, non_blocking = non_blocking) for k,v in batch.items()}
+    if not count_bytes and self.per_class_logging:
+      batch["n_tokens"] = n_tokens.to(device, non_blocking = non_blocking)
 
-    # capture the meta for the processed batch
-    am = batch["attention_mask"]
-    bytes_by_class = {c: 0 for c in range(n_classes)}
-    loss_by_class, acc_by_class = bytes_by_class.copy(), bytes_by_class.copy()
-    for i, c in enumerate(batch["class"].tolist()):
-      bytes_by_class[c] += n_bytes * am[i].sum().item()
-      loss_by_class[c] += loss[i].item()
-      acc_by_class[c] += out[i].argmax(-1).eq(target[i]).float().mean().item()
+    outputs = None
+    if train and self.cuda_graph and non_blocking and accum_steps == 1:
+      graph_key = (optim, n_bytes, n_classes, grad_clip, count_bytes)
+      if self._step_graph == None or self._step_graph_key != graph_key:
+        # these are baked into the captured step, so eg. a new optimizer needs a new graph
+        self._step_graph = _StepGraph(lambda b: self._graph_step(b, n_bytes, n_classes, optim, grad_clip, count_bytes), optim)
+        self._step_graph_key = graph_key
+      step_time, outputs = timeit(self._step_graph)(batch)
+
+    if outputs != None:
+      # the graph runs the entire step so there is no seperate forward and backward time
+      log_tensor, log_vecs = outputs
+      forward_pass_time, backward_pass_time = step_time, 0.
+    else:
+      forward_pass_time, _mean_loss, log_tensor, log_vecs = self._forward(batch, n_bytes, n_classes, count_bytes)
+      if train:
+        backward_pass_time = self._backward(_mean_loss, optim, grad_clip, step, accum_steps)
+
+    batch_meta[keys["forward_pass_time"]] = forward_pass_time
+    if train:
+      batch_meta[keys["backward_pass_time"]] = backward_pass_time
+      batch_meta[keys["total_time"]] = forward_pass_time + backward_pass_time
+
+    # the logged metrics only need this one sync, fp16 also syncs in ``GradScaler`` to check for inf gradients
+    host = torch.cat([log_tensor] if log_vecs == None else [log_tensor, log_vecs.view(-1)]).tolist()
+    loss_avg, acc_avg = host[0], host[1]
+    bytes_processed = int(host[2]) if count_bytes else int(n_tokens.sum()) * n_bytes
+    offset = len(log_tensor)
 
     # update the logging dict
-    bytes_processed = am.sum().item() * n_bytes
     batch_meta.update({
-      f"{prefix}/bytes_processed": bytes_processed,
-      f"{prefix}/bytes_processed_per_second": bytes_processed / forward_pass_time,
-      f"{prefix}/class_wise_bytes_processed": bytes_by_class,
-      f"{prefix}/loss_avg" : _mean_loss.item(),
-      f"{prefix}/acc_avg" : acc.item(),
-      f"{prefix}/loss_class" : loss_by_class,
-      f"{prefix}/acc_class" : acc_by_class,
+      keys["bytes_processed"]: bytes_processed,
+      keys["bytes_processed_per_second"]: bytes_processed / forward_pass_time,
+      keys["loss_avg"] : loss_avg,
+      keys["acc_avg"] : acc_avg,
     })
+    if log_vecs != None:
+      host_vecs = [host[offset + j * n_classes : offset + (j + 1) * n_classes] for j in range(3)]
+      batch_meta.update({
+        keys["class_wise_bytes_processed"]: {c: int(x) for c, x in enumerate(host_vecs[0])},
+        keys["loss_class"] : dict(enumerate(host_vecs[1])),
+        keys["acc_class"] : dict(enumerate(host_vecs[2])),
+      })
 
-    if train:
-      # run the backward pass
-      optim.zero_grad()
-      _mean_loss.backward()
-      
-      for p in self.model.parameters():
-        if p.requires_grad:
-          p.grad.data.clamp_(-grad_clip, grad_clip) # clip gradient values
-
-      backward_pass_time, _ = timeit(optim.step)()
-      batch_meta["train/backward_pass_time"] = backward_pass_time
-      batch_meta["train/total_time"] = forward_pass_time + backward_pass_time
-
-    pbar.set_description(f"[{prefix}] loss: {_mean_loss.item():.4f} | acc: {acc.item():.4f}")
+    pbar.set_description(f"[{self._prefix[train]}] loss: {loss_avg:.4f} | acc: {acc_avg:.4f}", refresh = False)
     return batch_meta
 
-  def train(self, optim, train_data, n_steps, test_every = None, test_data = None):
+  def train(self, optim, train_data, n_steps, test_every = None, test_data = None, accum_steps = 1):
     """Train model with given optimiser, data and number of steps, optionally provide testing
     material as well.
 
     Args:
       optim (torch.optim.Optimizer): The optimizer to use
-      train_data (``gperc.Consumer/ArrowConsumer``): The training data, batches must be created
+      train_data (``gperc.Consumer/ArrowConsumer``): The training data, batches must be created, can be
+        wrapped with ``Trainer.wrap_dataloader`` to load the batches in background workers
       n_steps (int): The number of steps to train for
       test_every (int): The number of steps to train for before testing, defaults to ``n_steps``
       test_data (``gperc.Consumer/ArrowConsumer``): The testing data, batches must be created
+      accum_steps (int): The number of batches to accumulate gradients over, defaults to 1
     """
-    pbar = trange(n_steps)
+    pbar = trange(n_steps, mininterval = 0.5, miniters = 10) # fewer terminal refreshes at high step rates
     min_loss = float("inf")
+    device = self.device
+    loader = getattr(train_data, "loader", None)
+    if device.type == "cuda" and loader != None and (loader.num_workers == 0 or not loader.pin_memory):
+      print(
+        f"train_data.loader has num_workers={loader.num_workers} and pin_memory={loader.pin_memory}, "
+        "use num_workers > 0 and pin_memory = True or the GPU will wait for the data"
+      )
+    if device.type == "cuda" and (self._copy_stream == None or self._copy_stream.device != device):
+      self._copy_stream = torch.cuda.Stream(device)
+    train_loader = _PrefetchLoader(train_data, device, self._copy_stream if device.type == "cuda" else None)
 
     for i in pbar:
-      batch = train_data.get_next_batch()
+      batch = train_loader.get_next_batch()
       batch_meta = self(
         batch = batch,
         step = i,
@@ -162,17 +580,18 @@ class Trainer():
         pbar = pbar,
         grad_clip = 1.0,
         optim = optim,
-        train = True
+        train = True,
+        accum_steps = accum_steps,
       )
 
       if i and test_every != None and test_data != None and i % test_every == 0:
-        pbar_val = trange(len(test_data._batches))
+        pbar_val = trange(len(test_data._batches), mininterval = 0.5, miniters = 10)
         
         # we need to capture the meta for the test batches since they can be more than one
         metas = []
-        for _ in pbar:
+        for _ in pbar_val:
           batch = test_data.get_next_batch()
-          batch_meta = self(
+          val_meta = self(
             batch = batch,
             step = i,
             n_bytes = test_data.n_bytes,
@@ -182,16 +601,20 @@ class Trainer():
             optim = optim,
             train = False
           )
-          metas.append(batch_meta)
+          metas.append(val_meta)
         
-        # mean over all batches
-        test_meta = {}
-        for k, v in zip(metas[0].keys(), zip(*[m[k] for m in metas])):
-          if isinstance(v, dict):
-            test_meta[k] = {k2: [m[k][k2] for m in metas] for k2 in v.keys()}
-            test_meta[k] = {k2: sum(v)/len(v) for k2, v in test_meta[k].items()}
-          else:
-            test_meta[k] = sum(v)/len(v)
+        # mean over all batches, sum everything in a single pass and divide at the end
+        agg, agg_d = defaultdict(float), {}
+        for m in metas:
+          for k, v in m.items():
+            if isinstance(v, dict):
+              _d = agg_d.setdefault(k, defaultdict(float))
+              for k2, v2 in v.items():
+                _d[k2] += v2
+            else:
+              agg[k] += v
+        test_meta = {k: v / len(metas) for k, v in agg.items()}
+        test_meta.update({k: {k2: v2 / len(metas) for k2, v2 in v.items()} for k, v in agg_d.items()})
         batch_meta.update(test_meta)
 
         print("val/loss:", test_meta["val/loss_avg"])
@@ -204,3 +627,5 @@ class Trainer():
       # log
       if self.client != None:
         self.client(batch_meta)
+
+    self.wait_for_saves()
@@ -1,15 +1,17 @@
 import random
+import tempfile
 import unittest
 from tqdm import trange
 
 import torch
 from torch.nn import functional as F
 
-from nbox.utils import folder, join
+from gperc.utils import folder, join
 
 from gperc import Perceiver, PerceiverConfig
 
 from gperc.configs import BinaryConfig, TextConfig, ImageConfig
+from gperc.models import enable_gradient_checkpointing
 from gperc.data import Consumer
 from gperc.arrow import ArrowConsumer
 from gperc.trainer import Trainer
@@ -350,6 +352,51 @@ from gperc.utils import set_seed, get_files_in_folder
 #         self.assertTrue(set(out.keys()) == {"input_array", "attention_mask", "class"})
 #         self.assertEqual(out["input_array"].shape, (6, 128))  # I5
 
+class _FixedBatches():
+    def __init__(self, batches, n_classes, n_bytes = 1):
+        """Cycles over a fixed list of batches, has the same interface as the consumers for ``Trainer.train``"""
+        self._batches = batches
+        self.n_classes = n_classes
+        self.n_bytes = n_bytes
+        self._i = 0
+
+    def get_next_batch(self):
+        batch = self._batches[self._i % len(self._batches)]
+        self._i += 1
+        return {k: v.clone() for k, v in batch.items()} # ``Trainer`` pops keys from the batch
+
+
+def _get_small_model(seed = 4, **kwargs):
+    config = BinaryConfig(
+        seqlen = 32,
+        vocab_size = 16,
+        latent_dim = 8,
+        latent_frac = 0.25,
+        n_classes = 4,
+        ffw_ratio = 1.0,
+        num_heads = 2,
+        num_layers = 2,
+        decoder_reduction = "mean",
+        **kwargs
+    )
+    set_seed(seed)
+    return Perceiver(config)
+
+
+def _get_batches(n_batches = 2, batch_size = 4, seqlen = 32, vocab_size = 16, n_classes = 4):
+    g = torch.Generator().manual_seed(0)
+    batches = []
+    for _ in range(n_batches):
+        lengths = torch.randint(1, seqlen + 1, (batch_size,), generator = g)
+        attention_mask = (torch.arange(seqlen)[None, :] < lengths[:, None]).long()
+        batches.append({
+            "input_array": torch.randint(0, vocab_size, (batch_size, seqlen), generator = g) * attention_mask,
+            "attention_mask": attention_mask,
+            "class": torch.randint(0, n_classes, (batch_size,), generator = g),
+        })
+    return batches
+
+
 class TestTrainer(unittest.TestCase):
     def test_trainer(self):
         folder_path = join(folder(__file__), "docs", "source")
@@ -407,3 +454,239 @@ class TestTrainer(unittest.TestCase):
 
             if sum(acc_over_time[-10:]) == 10:
                 break
+
+    def test_call_train_and_eval(self):
+        model = _get_small_model()
+        trainer = Trainer(model, save_folder = None, client = None)
+        optim = torch.optim.Adam(model.parameters(), lr = 0.001)
+        data = _FixedBatches(_get_batches(), n_classes = 4)
+        pbar = trange(3)
+        for train in [True, False]:
+            prefix = "train" if train else "val"
+            for i in pbar:
+                batch = data.get_next_batch()
+                meta = trainer(
+                    batch = batch,
+                    step = i,
+                    n_bytes = data.n_bytes,
+                    n_classes = data.n_classes,
+                    pbar = pbar,
+                    train = train,
+                    optim = optim
+                )
+                self.assertEqual(meta[f"{prefix}/step"], i)
+                self.assertEqual(meta[f"{prefix}/bytes_processed"], int(batch["attention_mask"].sum()))
+                self.assertTrue(0 <= meta[f"{prefix}/acc_avg"] <= 1)
+                self.assertEqual(f"{prefix}/backward_pass_time" in meta, train)
+                self.assertEqual(model.training, train)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA graphs need a GPU")
+    def test_cuda_graph(self):
+        data = _FixedBatches(_get_batches(), n_classes = 4)
+        models, optims, trainers = [], [], []
+        for cuda_graph in [False, True]:
+            model = _get_small_model(dropout = 0.0).cuda() # no dropout so both runs are the same
+            models.append(model)
+            optims.append(torch.optim.Adam(model.parameters(), lr = 0.001, capturable = True))
+            trainers.append(Trainer(model, save_folder = None, client = None, cuda_graph = cuda_graph))
+
+        # eager warmup steps, then the capture and replays
+        pbar = trange(6)
+        for i in pbar:
+            batch = data.get_next_batch()
+            metas = [
+                trainer(batch = {k: v.clone() for k, v in batch.items()}, step = i, n_bytes = 1, n_classes = 4, pbar = pbar, optim = optim)
+                for trainer, optim in zip(trainers, optims)
+            ]
+            self.assertAlmostEqual(metas[0]["train/loss_avg"], metas[1]["train/loss_avg"], places = 4)
+            self.assertEqual(metas[0]["train/bytes_processed"], metas[1]["train/bytes_processed"])
+        self.assertNotEqual(trainers[1]._step_graph.graph, None)
+        for p0, p1 in zip(models[0].parameters(), models[1].parameters()):
+            self.assertTrue(torch.allclose(p0, p1, atol = 1e-5))
+
+        # a new optimizer is not stepped by the old graph
+        graph = trainers[1]._step_graph
+        optim = torch.optim.Adam(models[1].parameters(), lr = 0.001, capturable = True)
+        trainers[1](batch = data.get_next_batch(), step = 6, n_bytes = 1, n_classes = 4, pbar = pbar, optim = optim)
+        self.assertIsNot(trainers[1]._step_graph, graph)
+        self.assertIs(trainers[1]._step_graph.optim, optim)
+
+        # batches with a different set of keys are left to the eager path
+        batch = {k: v.cuda() for k, v in data.get_next_batch().items()}
+        batch["n_tokens"] = batch["attention_mask"].sum(-1)
+        self.assertEqual(trainers[1]._step_graph(batch), None)
+
+    def test_accum_steps(self):
+        model = _get_small_model()
+        trainer = Trainer(model, save_folder = None, client = None)
+        optim = torch.optim.SGD(model.parameters(), lr = 0.01)
+        n_optim_steps = []
+        _step = optim.step
+        def step(*args, **kwargs):
+            n_optim_steps.append(1)
+            return _step(*args, **kwargs)
+        optim.step = step
+
+        data = _FixedBatches(_get_batches(), n_classes = 4)
+        pbar = trange(6)
+        calls_with_step = []
+        for i in pbar:
+            trainer(
+                batch = data.get_next_batch(),
+                step = i,
+                n_bytes = data.n_bytes,
+                n_classes = data.n_classes,
+                pbar = pbar,
+                optim = optim,
+                accum_steps = 3
+            )
+            calls_with_step.append(len(n_optim_steps))
+        self.assertEqual(calls_with_step, [0, 0, 1, 1, 1, 2])
+
+    def test_gradient_checkpointing(self):
+        model = _get_small_model()
+        batch = _get_batches(n_batches = 1, batch_size = 8)[0]
+        grads = []
+        for enable in [False, True]:
+            enable_gradient_checkpointing(model, enable)
+            model.zero_grad(set_to_none = True)
+            set_seed(4) # same dropout masks, checkpointing restores the rng state for the recompute
+            F.cross_entropy(model(batch["input_array"]), batch["class"]).backward()
+            grads.append({n: p.grad.clone() for n, p in model.named_parameters() if p.grad != None})
+        self.assertEqual(set(grads[0]), set(grads[1]))
+        for n in grads[0]:
+            self.assertTrue(torch.allclose(grads[0][n], grads[1][n], atol = 1e-6), n)
+
+    def test_per_class_logging(self):
+        model = _get_small_model()
+        trainer = Trainer(model, save_folder = None, client = None, per_class_logging = True)
+        batch = _get_batches(n_batches = 1, batch_size = 8)[0]
+
+        # the per sample loop that the class wise values are matched against
+        model.eval()
+        with torch.no_grad():
+            out = model(batch["input_array"])
+        target = batch["class"]
+        loss = F.cross_entropy(out, target, reduction = "none")
+        am = batch["attention_mask"]
+        bytes_by_class = {c: 0 for c in range(4)}
+        loss_by_class, acc_by_class = bytes_by_class.copy(), bytes_by_class.copy()
+        for i, c in enumerate(target.tolist()):
+            bytes_by_class[c] += am[i].sum().item()
+            loss_by_class[c] += loss[i].item()
+            acc_by_class[c] += out[i].argmax(-1).eq(target[i]).float().item()
+
+        # with and without the token counts from the consumers
+        for n_tokens in [False, True]:
+            _batch = {k: v.clone() for k, v in batch.items()}
+            if n_tokens:
+                _batch["n_tokens"] = am.sum(-1)
+            meta = trainer(batch = _batch, step = 0, n_bytes = 1, n_classes = 4, pbar = trange(1), train = False)
+            self.assertEqual(meta["val/class_wise_bytes_processed"], bytes_by_class)
+            self.assertEqual(set(meta["val/loss_class"]), set(loss_by_class))
+            for c in loss_by_class:
+                self.assertAlmostEqual(meta["val/loss_class"][c], loss_by_class[c], places = 5)
+                self.assertAlmostEqual(meta["val/acc_class"][c], acc_by_class[c], places = 5)
+
+    def test_loss_reduction(self):
+        batch = _get_batches(n_batches = 1, batch_size = 8)[0]
+        metas = []
+        for per_class_logging in [False, True]:
+            trainer = Trainer(_get_small_model(), save_folder = None, client = None, per_class_logging = per_class_logging)
+            _batch = {k: v.clone() for k, v in batch.items()}
+            metas.append(trainer(batch = _batch, step = 0, n_bytes = 1, n_classes = 4, pbar = trange(1), train = False))
+
+        model = _get_small_model().eval()
+        with torch.no_grad():
+            loss = F.cross_entropy(model(batch["input_array"]), batch["class"], reduction = "none")
+        for meta in metas:
+            self.assertAlmostEqual(meta["val/loss_avg"], loss.mean().item(), places = 5)
+        self.assertNotIn("val/loss_class", metas[0])
+
+    def test_val_aggregation(self):
+        metas = []
+        model = _get_small_model()
+        trainer = Trainer(model, save_folder = None, client = metas.append, per_class_logging = True)
+        optim = torch.optim.Adam(model.parameters(), lr = 0.001)
+        train_data = _FixedBatches(_get_batches(), n_classes = 4)
+        val_batches = _get_batches(n_batches = 3, batch_size = 8)
+        trainer.train(optim, train_data, n_steps = 2, test_every = 1, test_data = _FixedBatches(val_batches, n_classes = 4))
+        self.assertEqual(len(metas), 2)
+        self.assertNotIn("val/loss_avg", metas[0])
+
+        # the model is not updated after validation, so the same values come out for each batch
+        val_metas = [
+            trainer(batch = {k: v.clone() for k, v in b.items()}, step = 1, n_bytes = 1, n_classes = 4, pbar = trange(1), train = False)
+            for b in val_batches
+        ]
+        for k in ["val/loss_avg", "val/acc_avg", "val/bytes_processed"]:
+            self.assertAlmostEqual(metas[1][k], sum(m[k] for m in val_metas) / len(val_metas), places = 5)
+        for k in ["val/loss_class", "val/acc_class", "val/class_wise_bytes_processed"]:
+            for c in range(4):
+                self.assertAlmostEqual(metas[1][k][c], sum(m[k][c] for m in val_metas) / len(val_metas), places = 5)
+
+    def test_save_load(self):
+        model = _get_small_model()
+        with tempfile.TemporaryDirectory() as save_folder:
+            trainer = Trainer(model, save_folder = save_folder, client = None)
+            optim = torch.optim.Adam(model.parameters(), lr = 0.001)
+            data = _FixedBatches(_get_batches(), n_classes = 4)
+            pbar = trange(2)
+            for i in pbar:
+                trainer(batch = data.get_next_batch(), step = i, n_bytes = 1, n_classes = 4, pbar = pbar, optim = optim)
+            trainer.save("step_1", optim)
+            trainer.wait_for_saves()
+
+            # load into a fresh model and optimizer with different weights
+            new_model = _get_small_model(seed = 5)
+            new_optim = torch.optim.Adam(new_model.parameters(), lr = 0.001)
+            new_trainer = Trainer(new_model, save_folder = None, client = None)
+            new_trainer.load(join(save_folder, "step_1"), new_optim)
+            trainer.close()
+
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.equal(v, new_model.state_dict()[k]), k)
+        state, new_state = optim.state_dict(), new_optim.state_dict()
+        self.assertEqual(state["param_groups"], new_state["param_groups"])
+        for p, s in state["state"].items():
+            for k, v in s.items():
+                self.assertTrue(torch.equal(v, new_state["state"][p][k]), k)
+
+    def test_n_tokens(self):
+        folder_path = join(folder(__file__), "docs", "source")
+        fps = get_files_in_folder(folder_path, [".rst"], sort=True)[:4]
+        class_to_id = {"tinker": 0, "tailor": 1}
+        dataset = {f: ["tinker", "tailor"][i % 2] for i, f in enumerate(fps)}
+        for consumer in [ArrowConsumer, Consumer]:
+            data = consumer(dataset, seqlen = 128, n_bytes=1, class_to_id=class_to_id)
+            data.create_batches(batch_size=2)
+            batch = data.get_next_batch()
+            self.assertTrue(torch.equal(batch["n_tokens"], batch["attention_mask"].sum(-1)))
+
+    def test_wrap_dataloader(self):
+        folder_path = join(folder(__file__), "docs", "source")
+        fps = get_files_in_folder(folder_path, [".rst"], sort=True)[:4]
+        class_to_id = {"tinker": 0, "tailor": 1}
+        dataset = {f: ["tinker", "tailor"][i % 2] for i, f in enumerate(fps)}
+        for consumer in [ArrowConsumer, Consumer]:
+            data = consumer(dataset, seqlen = 128, n_bytes=1, class_to_id=class_to_id)
+            query = None
+            if consumer == Consumer:
+                data.set_supervised_mode()
+                query = "supervised"
+            data.create_batches(batch_size=4)
+            loader = Trainer.wrap_dataloader(data, num_workers = 0, pin_memory = False)
+            self.assertEqual((loader.n_bytes, loader.n_classes), (1, 2))
+
+            # one full epoch in the order of the batches, then the next epoch is shuffled with a new seed
+            batches = data._batches
+            for x in batches + [None]:
+                batch = loader.get_next_batch()
+                if x == None:
+                    self.assertEqual(data.seed, 5)
+                    self.assertNotEqual(data._batches, batches)
+                    x = data._batches[0]
+                expected = data[x] if query == None else data[x, query]
+                self.assertEqual(set(batch), {"input_array", "attention_mask", "class", "n_tokens"})
+                for k, v in expected.items():
+                    self.assertTrue(torch.equal(batch[k], v), k)